@@ -1,9 +1,19 @@
 import os
-import json
+import calendar
+import functools
+import random
+import signal
+import threading
+import time
+import unicodedata
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-import tweepy
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
 import logging
 
 # Configure logging
@@ -13,184 +23,613 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load environment variables
-load_dotenv()
-
-# Twitter credentials
-BEARER_TOKEN = os.getenv("BEARER_TOKEN")
-ACCESS_TOKEN = os.getenv("ACCESS_TOKEN")
-ACCESS_SECRET = os.getenv("ACCESS_SECRET")
-API_KEY = os.getenv("API_KEY")
-API_SECRET = os.getenv("API_SECRET")
-CLIENT_ID = os.getenv("CLIENT_ID")
-CLIENT_SECRET = os.getenv("CLIENT_SECRET")
-
-# Gemini API key
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-
-# Validate required environment variables
-required_vars = [
+# Credentials the bot cannot run without
+REQUIRED_VARS = [
     "API_KEY", "API_SECRET", 
     "ACCESS_TOKEN", "ACCESS_SECRET", "GEMINI_API_KEY"
 ]
 
-missing_vars = [var for var in required_vars if not os.getenv(var)]
-if missing_vars:
-    raise ValueError(f"Missing required environment variables: {missing_vars}")
-
-# Initialize Twitter client
-twitter_client = tweepy.Client(
-    bearer_token=BEARER_TOKEN,
-    consumer_key=API_KEY,
-    consumer_secret=API_SECRET,
-    access_token=ACCESS_TOKEN,
-    access_token_secret=ACCESS_SECRET,
-)
+@dataclass(frozen=True)
+class Config:
+    # Twitter credentials
+    bearer_token: Optional[str]
+    access_token: str
+    access_secret: str
+    api_key: str
+    api_secret: str
+    client_id: Optional[str]
+    client_secret: Optional[str]
+    
+    # Gemini API key
+    gemini_api_key: str
+
+@functools.cache
+def _config():
+    """Load and validate environment variables on first use rather than at import"""
+    load_dotenv()
+    
+    missing_vars = [var for var in REQUIRED_VARS if not os.getenv(var)]
+    if missing_vars:
+        raise ValueError(f"Missing required environment variables: {missing_vars}")
+    
+    return Config(
+        bearer_token=os.getenv("BEARER_TOKEN"),
+        access_token=os.getenv("ACCESS_TOKEN"),
+        access_secret=os.getenv("ACCESS_SECRET"),
+        api_key=os.getenv("API_KEY"),
+        api_secret=os.getenv("API_SECRET"),
+        client_id=os.getenv("CLIENT_ID"),
+        client_secret=os.getenv("CLIENT_SECRET"),
+        gemini_api_key=os.getenv("GEMINI_API_KEY"),
+    )
+
+@functools.cache
+def _twitter_client():
+    """Twitter client, built on first use so importing this module skips tweepy"""
+    import tweepy
+    
+    config = _config()
+    return tweepy.Client(
+        bearer_token=config.bearer_token,
+        consumer_key=config.api_key,
+        consumer_secret=config.api_secret,
+        access_token=config.access_token,
+        access_token_secret=config.access_secret,
+    )
+
+# On-disk cache for byabbe.se responses, which are stable for a given date
+CACHE_DIR = Path.home() / ".cache" / "twt"
+CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+
+# Events passed to Gemini; it only picks 3, so the full list just inflates the prompt
+MAX_PROMPT_EVENTS = 30
+MAX_EVENT_DESCRIPTION = 200  # chars; longer events are only used to fill the sample
+
+# (connect, read) timeouts in seconds, so a dead endpoint fails fast
+REQUEST_TIMEOUT = (3.05, 27)
+
+# Hard wall-clock budget for a whole run, in seconds
+RUN_DEADLINE = 120
+
+# A BaseException so the per-step "except Exception" handlers don't swallow it
+class RunTimeout(BaseException):
+    """Raised when a run exceeds RUN_DEADLINE"""
+
+def _on_deadline(signum, frame):
+    raise RunTimeout()
+
+# Concurrent requests allowed per upstream across all bots in this process,
+# so a stalled Gemini call can't hold up byabbe.se fetches (or vice versa)
+GEMINI_CONCURRENCY = 2
+EVENTS_CONCURRENCY = 5
+_gemini_slots = threading.BoundedSemaphore(GEMINI_CONCURRENCY)
+_events_slots = threading.BoundedSemaphore(EVENTS_CONCURRENCY)
+
+def _host_session(base_url, pool_size):
+    """Session with its own connection pool for a single upstream host"""
+    session = requests.Session()
+    session.mount(base_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return session
+
+# Statuses worth retrying; any other HTTP error is raised immediately
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504, 529}
+
+def _retry(fn, *, retries=3, base=1.0, cap=30.0, jitter=0.5):
+    """Call fn, retrying transient failures with exponential backoff and jitter"""
+    for attempt in range(retries + 1):
+        try:
+            return fn()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            delay = min(cap, base * 2 ** attempt) * (1 + random.uniform(0, jitter))
+            logger.warning("Request failed (%s), retrying in %.1fs", e, delay)
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status not in RETRYABLE_STATUSES or attempt == retries:
+                raise
+            delay = min(cap, base * 2 ** attempt) * (1 + random.uniform(0, jitter))
+            
+            # Honor the server's Retry-After hint when it gives one in seconds
+            retry_after = e.response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = min(cap, float(retry_after))
+            logger.warning("HTTP %s, retrying in %.1fs", status, delay)
+        time.sleep(delay)
+
+def _atomic_write(path, data):
+    """Write bytes to path via a temp file, so a crash never leaves it truncated"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+_CLOSED_CIRCUIT = {"failures": 0, "last_failure_ts": 0, "state": "closed"}
+
+# After threshold failures less than window seconds apart the circuit opens
+# and calls are skipped for cooldown seconds; the next call is a half-open
+# probe that closes it on success and reopens it on failure. The defaults
+# suit the daily workflow, which caches ~/.cache/twt so state carries over:
+# three failed days in a row open it, the next day is skipped, the one after probes.
+class CircuitBreaker:
+    """Skip calls to an upstream that keeps failing, persisted across runs"""
+    
+    def __init__(self, path, threshold=3, window=36 * 60 * 60, cooldown=36 * 60 * 60):
+        self.path = path
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+    
+    def _load(self):
+        try:
+            state = orjson.loads(self.path.read_bytes())
+            if isinstance(state, dict):
+                # Fill in any keys missing from a partial file
+                return {**_CLOSED_CIRCUIT, **state}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read circuit state: %s", e)
+        return dict(_CLOSED_CIRCUIT)
+    
+    def _save(self, state):
+        try:
+            _atomic_write(self.path, orjson.dumps(state))
+        except OSError as e:
+            logger.warning("Could not write circuit state: %s", e)
+    
+    def allow(self):
+        """Whether a call should be attempted now"""
+        state = self._load()
+        if state["state"] != "open":
+            return True
+        if time.time() - state["last_failure_ts"] < self.cooldown:
+            return False
+        state["state"] = "half_open"
+        self._save(state)
+        return True
+    
+    def record_success(self):
+        state = self._load()
+        if state["state"] != "closed" or state["failures"]:
+            self._save(_CLOSED_CIRCUIT)
+    
+    def record_failure(self):
+        state = self._load()
+        now = time.time()
+        
+        # Only failures close together count towards tripping the circuit; a
+        # failed probe always comes after the cooldown, so it keeps the count
+        if state["state"] != "half_open" and now - state["last_failure_ts"] > self.window:
+            state["failures"] = 0
+        state["failures"] += 1
+        state["last_failure_ts"] = now
+        
+        if state["state"] == "half_open" or state["failures"] >= self.threshold:
+            if state["state"] != "open":
+                logger.warning("Circuit open for %s after %d failures", self.path.stem, state["failures"])
+            state["state"] = "open"
+        self._save(state)
+
+def _ordinal(day):
+    """Ordinal suffix for a day of the month (e.g., 'st' for 1)"""
+    if 10 <= day % 100 <= 20:
+        return 'th'
+    return {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
+
+# Every (month, day) mapped to its display string, using a leap year so Feb 29 is included
+_DATE_STRINGS = {
+    (m, d): f"{calendar.month_abbr[m]} {d}{_ordinal(d)}"
+    for m in range(1, 13)
+    for d in range(1, calendar.monthrange(2024, m)[1] + 1)
+}
+
+# Tweets generated per Gemini call; the extra days are queued on disk
+BATCH_DAYS = 7
+QUEUE_PATH = CACHE_DIR / "_queue.json"
+
+# Gemini prompt, filled in with tweet_count, example_date and days_text per run
+_PROMPT_TEMPLATE = """Create Twitter posts about historical events, one post for each date below.
+
+EXACT FORMAT REQUIRED FOR EACH POST:
+📅 {example_date} in history:
+• YEAR — Brief description of event
+• YEAR — Brief description of event  
+• YEAR — Brief description of event
+#OTD #History
+
+RULES:
+- Start each post with "📅 DATE in history:" using that post's date, as in the example above
+- Use bullet points with • symbol
+- Format each event as "YEAR — description"
+- Select 3 interesting but lesser-known events (avoid the most famous ones)
+- Keep descriptions very brief to fit under 280 characters total
+- End each post with "#OTD #History"
+- Make sure each post is under 280 characters
+
+{days_text}
+
+Return only a JSON array of {tweet_count} strings, one post per date in the order given."""
+
+# One day's section of the prompt
+_DAY_TEMPLATE = """Historical events for {formatted_date}:
+{events_text}"""
+
+# Rough input-token ceiling per day in the prompt
+PROMPT_TOKEN_BUDGET = 4000
+
+def _estimate_tokens(text):
+    """Approximate token count, at the ~4 characters per token Gemini averages"""
+    return (len(text) + 3) // 4
+
+# maxOutputTokens is added per call, scaled by the number of days
+MAX_TWEET_TOKENS = 300
+_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "topK": 40,
+    "topP": 0.9,
+    "responseMimeType": "application/json",
+}
+
+# Twitter counts code points in these ranges as 1 and everything else
+# (including "•" and emoji) as 2, against a limit of 280
+TWEET_LIMIT = 280
+_LIGHT_RANGES = ((0, 4351), (8192, 8205), (8208, 8223), (8242, 8247))
+
+def _char_weight(char):
+    cp = ord(char)
+    for low, high in _LIGHT_RANGES:
+        if low <= cp <= high:
+            return 1
+    return 2
+
+def _weighted_length(text):
+    """Length of text as Twitter counts it towards TWEET_LIMIT"""
+    return sum(_char_weight(c) for c in unicodedata.normalize("NFC", text))
+
+def _fit_tweet(text):
+    """Shorten a tweet to TWEET_LIMIT, dropping whole event lines before cutting text"""
+    lines = text.split('\n')
+    if len(lines) >= 4:  # Header + events + hashtags
+        header, events, footer = lines[0], lines[1:-1], lines[-1]
+        
+        # Binary search for the most leading events that still fit
+        low, high = 0, len(events) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if _weighted_length('\n'.join([header, *events[:mid], footer])) <= TWEET_LIMIT:
+                low = mid
+            else:
+                high = mid - 1
+        if low:
+            return '\n'.join([header, *events[:low], footer])
+    
+    # Last resort: cut the text itself, leaving room for the ellipsis
+    budget = TWEET_LIMIT - 3
+    text = unicodedata.normalize("NFC", text)
+    for i, char in enumerate(text):
+        budget -= _char_weight(char)
+        if budget < 0:
+            return text[:i] + "..."
+    return text
 
 class HistoryBot:
     def __init__(self):
         self.gemini_url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
         self.headers = {
             'Content-Type': 'application/json',
-            'X-goog-api-key': GEMINI_API_KEY
+            'X-goog-api-key': _config().gemini_api_key
         }
         
-    def get_formatted_date(self):
-        """Get formatted date string (e.g., 'Aug 14th')"""
-        today = datetime.now()
-        month_name = today.strftime("%b")
-        day = today.day
+        # One keep-alive pool per upstream, so connections are reused across
+        # calls and a slow host can't exhaust the other's pool. Only the
+        # Gemini session carries the API key.
+        self.gemini_session = _host_session("https://generativelanguage.googleapis.com/", GEMINI_CONCURRENCY)
+        self.gemini_session.headers.update(self.headers)
+        self.events_session = _host_session("https://byabbe.se/", EVENTS_CONCURRENCY)
         
-        # Add ordinal suffix
-        if 10 <= day % 100 <= 20:
-            suffix = 'th'
-        else:
-            suffix = {1: 'st', 2: 'nd', 3: 'rd'}.get(day % 10, 'th')
+        # Stop paying the full timeout on every run while Gemini is down
+        self.gemini_breaker = CircuitBreaker(CACHE_DIR / "_gemini_circuit.json")
         
-        return f"{month_name} {day}{suffix}"
+    def get_formatted_date(self, today):
+        """Get formatted date string (e.g., 'Aug 14th')"""
+        return _DATE_STRINGS[(today.month, today.day)]
         
-    def fetch_historical_events(self):
-        """Fetch historical events for today's date"""
+    def fetch_historical_events(self, today):
+        """Fetch historical events for today's date as one "YEAR: description" line each"""
         try:
-            today = datetime.now()
-            url = f"https://byabbe.se/on-this-day/{today.month}/{today.day}/events.json"
+            data = self._load_events_data(today.month, today.day)
+            events = data.get("events", ())
+            fetched = len(events)
             
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
+            # Prefer brief events, since the tweet needs short descriptions
+            brief = [e for e in events if len(e['description']) <= MAX_EVENT_DESCRIPTION]
+            if len(brief) >= MAX_PROMPT_EVENTS:
+                events = brief
             
-            data = response.json()
-            events = data.get("events", [])
+            # Seeded by date so reruns on the same day see the same subset
+            rng = random.Random(today.toordinal())
+            events = rng.sample(events, min(MAX_PROMPT_EVENTS, len(events)))
             
-            # Format events for better processing
-            formatted_events = []
-            for event in events:
-                formatted_events.append(f"{event['year']}: {event['description']}")
+            # Format events straight into the text block the prompt needs
+            events_text = "\n".join(f"{event['year']}: {event['description']}" for event in events)
             
-            logger.info(f"Fetched {len(formatted_events)} events for {today.month}/{today.day}")
-            return formatted_events
+            logger.info("Fetched %d events for %d/%d, using %d", fetched, today.month, today.day, len(events))
+            return events_text
             
         except requests.RequestException as e:
-            logger.error(f"Error fetching events: {e}")
-            return []
+            logger.error("Error fetching events: %s", e)
+            return ""
         except Exception as e:
-            logger.error(f"Unexpected error: {e}")
-            return []
+            logger.error("Unexpected error: %s", e)
+            return ""
+    
+    def _load_events_data(self, month, day):
+        """Load byabbe.se events for a date, using the on-disk cache when fresh"""
+        cache_path = CACHE_DIR / f"otd-{month}-{day}.json"
+        try:
+            age = time.time() - cache_path.stat().st_mtime
+        except OSError:
+            age = None
+        
+        if age is not None and age < CACHE_TTL:
+            data = self._read_cache(cache_path)
+            if data is not None:
+                logger.info("Using cached events for %d/%d", month, day)
+                return data
+        
+        url = f"https://byabbe.se/on-this-day/{month}/{day}/events.json"
+        
+        def request():
+            with _events_slots:
+                response = self.events_session.get(url, timeout=REQUEST_TIMEOUT)
+            response.raise_for_status()
+            return response
+        
+        try:
+            response = _retry(request)
+        except requests.RequestException as e:
+            # Fall back to a stale copy rather than skipping today's tweet
+            data = self._read_cache(cache_path) if age is not None else None
+            if data is None:
+                raise
+            logger.warning("Error fetching events (%s), using stale cache", e)
+            return data
+        
+        data = orjson.loads(response.content)
+        
+        try:
+            _atomic_write(cache_path, response.content)
+        except OSError as e:
+            logger.warning("Could not write events cache: %s", e)
+        
+        return data
     
-    def generate_tweet_with_gemini(self, events):
-        """Generate tweet using Gemini 2.0 Flash"""
-        if not events:
+    def _read_cache(self, path):
+        """Read a cached JSON file, returning None if it is missing or corrupt"""
+        try:
+            return orjson.loads(path.read_bytes())
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read events cache %s: %s", path, e)
             return None
-            
-        events_text = "\n".join(events)
-        formatted_date = self.get_formatted_date()
+    
+    def _build_prompt(self, days):
+        """Fill the prompt template from (date, events_text) pairs"""
+        days_text = "\n\n".join(
+            _DAY_TEMPLATE.format(formatted_date=self.get_formatted_date(day), events_text=events_text)
+            for day, events_text in days
+        )
+        return _PROMPT_TEMPLATE.format(
+            tweet_count=len(days),
+            example_date=self.get_formatted_date(days[0][0]),
+            days_text=days_text,
+        )
+    
+    def generate_tweets_with_gemini(self, days):
+        """Generate one tweet per (date, events_text) pair in a single Gemini 2.0 Flash call.
         
-        prompt = f"""Create a Twitter post about historical events that happened on this day.
-
-EXACT FORMAT REQUIRED:
-📅 {formatted_date} in history:
-• YEAR — Brief description of event
-• YEAR — Brief description of event  
-• YEAR — Brief description of event
-#OTD #History
-
-RULES:
-- Start with "📅 {formatted_date} in history:"
-- Use bullet points with • symbol
-- Format each event as "YEAR — description"
-- Select 3 interesting but lesser-known events (avoid the most famous ones)
-- Keep descriptions very brief to fit under 280 characters total
-- End with "#OTD #History"
-- Make sure the entire tweet is under 280 characters
-
-Historical events for today:
-{events_text}
-
-Generate only the tweet text in the exact format shown above:"""
-
+        Returns a dict mapping ISO dates to tweet text, empty on failure.
+        """
+        if not days:
+            return {}
+        
+        prompt = self._build_prompt(days)
+        
+        # Halve each day's (already shuffled) events until the prompt fits the
+        # budget, rather than paying for a generateContent call on an oversized prompt
+        budget = PROMPT_TOKEN_BUDGET * len(days)
+        while _estimate_tokens(prompt) > budget and any(text.count('\n') >= 3 for _, text in days):
+            days = [
+                (day, '\n'.join(text.split('\n')[:max(3, text.count('\n') // 2 + 1)]))
+                for day, text in days
+            ]
+            prompt = self._build_prompt(days)
+            logger.warning("Prompt over %d tokens, trimmed events", budget)
         payload = {
             "contents": [{
                 "parts": [{
                     "text": prompt
                 }]
             }],
-            "generationConfig": {
-                "temperature": 0.7,
-                "topK": 40,
-                "topP": 0.9,
-                "maxOutputTokens": 300,
-            }
+            "generationConfig": {**_GENERATION_CONFIG, "maxOutputTokens": MAX_TWEET_TOKENS * len(days)},
         }
+        body = orjson.dumps(payload)
         
         try:
-            response = requests.post(
-                self.gemini_url,
-                headers=self.headers,
-                json=payload,
-                timeout=30
-            )
-            response.raise_for_status()
+            def request():
+                with _gemini_slots:
+                    response = self.gemini_session.post(
+                        self.gemini_url,
+                        data=body,
+                        timeout=REQUEST_TIMEOUT
+                    )
+                response.raise_for_status()
+                return response
+            
+            # Only transport errors, HTTP errors and timeouts count against the
+            # breaker, and only while Gemini itself is being called; bad output
+            # below is logged and left for the next run
+            try:
+                response = _retry(request)
+            except (requests.RequestException, RunTimeout):
+                self.gemini_breaker.record_failure()
+                raise
+            self.gemini_breaker.record_success()
+            
+            result = orjson.loads(response.content)
+            
+            if not (candidates := result.get('candidates')):
+                logger.error("No content generated by Gemini")
+                return {}
             
-            result = response.json()
+            tweet_texts = orjson.loads(candidates[0]['content']['parts'][0]['text'])
+            if not isinstance(tweet_texts, list):
+                logger.error("Gemini did not return a JSON array of tweets")
+                return {}
+            if len(tweet_texts) != len(days):
+                # Tweets are matched to dates by position, so a missing one shifts every later date
+                logger.error("Expected %d tweets from Gemini, got %d", len(days), len(tweet_texts))
+                return {}
             
-            if 'candidates' in result and result['candidates']:
-                tweet_text = result['candidates'][0]['content']['parts'][0]['text'].strip()
+            tweets = {}
+            for (day, _), tweet_text in zip(days, tweet_texts):
+                if not isinstance(tweet_text, str) or not tweet_text.strip():
+                    continue
+                tweet_text = tweet_text.strip()
+                
+                # Never queue a tweet whose header names a different date
+                formatted_date = self.get_formatted_date(day)
+                if formatted_date not in tweet_text.split('\n', 1)[0]:
+                    logger.warning("Dropping tweet for %s with wrong date header: %s", day.date(), tweet_text)
+                    continue
                 
                 # Ensure tweet is within character limit
-                if len(tweet_text) > 280:
-                    logger.warning(f"Generated tweet too long ({len(tweet_text)} chars)")
-                    # Try to truncate gracefully
-                    lines = tweet_text.split('\n')
-                    if len(lines) >= 4:  # Header + 3 events + hashtags
-                        # Remove one event and try again
-                        tweet_text = '\n'.join(lines[:3] + lines[-1:])
-                        if len(tweet_text) > 280:
-                            tweet_text = tweet_text[:277] + "..."
+                length = _weighted_length(tweet_text)
+                if length > TWEET_LIMIT:
+                    logger.warning("Generated tweet too long (%d chars)", length)
+                    tweet_text = _fit_tweet(tweet_text)
+                    length = _weighted_length(tweet_text)
                 
-                logger.info(f"Generated tweet ({len(tweet_text)} chars): {tweet_text}")
-                return tweet_text
-            else:
-                logger.error("No content generated by Gemini")
-                return None
+                logger.info("Generated tweet for %s (%d chars): %s", day.date(), length, tweet_text)
+                tweets[day.date().isoformat()] = tweet_text
+            return tweets
                 
         except requests.RequestException as e:
-            logger.error(f"Error calling Gemini API: {e}")
-            return None
+            logger.error("Error calling Gemini API: %s", e)
+            return {}
         except Exception as e:
-            logger.error(f"Error processing Gemini response: {e}")
-            return None
+            logger.error("Error processing Gemini response: %s", e)
+            return {}
+    
+    def _load_queue(self):
+        """Read queued tweets keyed by ISO date, or an empty queue"""
+        try:
+            queue = orjson.loads(QUEUE_PATH.read_bytes())
+            return queue if isinstance(queue, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read tweet queue: %s", e)
+            return {}
+    
+    def _save_queue(self, queue):
+        """Write the tweet queue atomically"""
+        try:
+            _atomic_write(QUEUE_PATH, orjson.dumps(queue))
+        except OSError as e:
+            logger.warning("Could not write tweet queue: %s", e)
+    
+    def _generate_batch(self, today):
+        """Generate and queue tweets for the next BATCH_DAYS days, returning the new ones"""
+        key = today.date().isoformat()
+        
+        # With Gemini unavailable only today's events are needed, for a templated tweet
+        if not self.gemini_breaker.allow():
+            logger.warning("Gemini circuit open, using templated tweet")
+            events_text = self.fetch_historical_events(today)
+            if not events_text:
+                logger.warning("No events fetched for today")
+                return {}
+            return {key: self._fallback_tweet(today, events_text)}
+        
+        # Warm the Gemini connection while byabbe.se is in flight
+        self._preconnect_gemini()
+        
+        days = [today + timedelta(days=offset) for offset in range(BATCH_DAYS)]
+        
+        events_texts = self._fetch_days(days)
+        
+        if not events_texts[0]:
+            logger.warning("No events fetched for today")
+            return {}
+        
+        tweets = self.generate_tweets_with_gemini(
+            [(day, events_text) for day, events_text in zip(days, events_texts) if events_text]
+        )
+        if not tweets:
+            return {}
+        
+        # Merge so future tweets still queued from an earlier batch survive
+        self._save_queue({**self._load_queue(), **tweets})
+        
+        # Today's tweet can be dropped on its header while the rest survive;
+        # post a templated one from the events already fetched instead
+        if key not in tweets:
+            logger.warning("No usable Gemini tweet for today, using templated tweet")
+            tweets[key] = self._fallback_tweet(today, events_texts[0])
+        return tweets
+    
+    def _fetch_days(self, days):
+        """Fetch events for several days concurrently, in date order"""
+        events_texts = [""] * len(days)
+        
+        def fetch(index, day):
+            events_texts[index] = self.fetch_historical_events(day)
+        
+        # Daemon threads, so fetches still retrying when the deadline fires
+        # don't keep the process alive at exit; _events_slots caps concurrency
+        threads = [threading.Thread(target=fetch, args=(i, day), daemon=True) for i, day in enumerate(days)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return events_texts
+    
+    def _preconnect_gemini(self):
+        """Open the Gemini TLS connection in the background so the later POST reuses it"""
+        def preconnect():
+            try:
+                with _gemini_slots:
+                    self.gemini_session.head(self.gemini_url, timeout=5)
+            except requests.RequestException as e:
+                # Non-fatal: the POST just opens its own connection
+                logger.debug("Gemini preconnect failed: %s", e)
+        
+        threading.Thread(target=preconnect, daemon=True).start()
+    
+    def _fallback_tweet(self, today, events_text):
+        """Build a tweet from the shortest of today's events without calling Gemini"""
+        lines = events_text.split('\n')
+        chosen = set(sorted(lines, key=len)[:3])
+        bullets = [f"• {line.replace(': ', ' — ', 1)}" for line in lines if line in chosen]
+        tweet_text = '\n'.join([f"📅 {self.get_formatted_date(today)} in history:", *bullets, "#OTD #History"])
+        if _weighted_length(tweet_text) > TWEET_LIMIT:
+            tweet_text = _fit_tweet(tweet_text)
+        return tweet_text
     
     def post_tweet(self, text):
         """Post tweet to Twitter"""
+        import tweepy
+        
         if not text:
             logger.error("No text provided for tweet")
             return False
             
         try:
-            response = twitter_client.create_tweet(text=text)
+            response = _twitter_client().create_tweet(text=text)
             tweet_id = response.data['id']
-            tweet_url = f"https://twitter.com/user/status/{tweet_id}"
             
-            logger.info(f"✅ Tweet posted successfully: {tweet_url}")
+            logger.info("✅ Tweet posted successfully: https://twitter.com/user/status/%s", tweet_id)
             return True
             
         except tweepy.TooManyRequests:
@@ -200,33 +639,58 @@ Generate only the tweet text in the exact format shown above:"""
             logger.error("❌ Twitter API access forbidden - check credentials")
             return False
         except Exception as e:
-            logger.error(f"❌ Error posting tweet: {e}")
+            logger.error("❌ Error posting tweet: %s", e)
             return False
     
     def run(self):
         """Main execution function"""
-        logger.info(f"🚀 Starting history bot at {datetime.now()}")
-        
-        # Fetch events
-        events = self.fetch_historical_events()
-        if not events:
-            logger.warning("No events fetched, exiting")
-            return False
+        # Snapshot the date once so a run straddling midnight stays consistent
+        today = datetime.now()
+        logger.info("🚀 Starting history bot at %s", today)
         
-        # Generate tweet
-        tweet_text = self.generate_tweet_with_gemini(events)
-        if not tweet_text:
-            logger.warning("Failed to generate tweet, exiting")
-            return False
+        # signal.alarm is POSIX-only and only usable from the main thread;
+        # elsewhere the run relies on request timeouts
+        use_alarm = hasattr(signal, "SIGALRM") and threading.current_thread() is threading.main_thread()
+        if use_alarm:
+            previous_handler = signal.signal(signal.SIGALRM, _on_deadline)
+            signal.alarm(RUN_DEADLINE)
         
-        # Post tweet
-        success = self.post_tweet(tweet_text)
-        if success:
-            logger.info("✅ Bot completed successfully")
-            return True
-        else:
-            logger.error("❌ Bot failed to post tweet")
+        # The steps depend on each other (events -> Gemini -> post), so they run
+        # in order; only the independent per-day fetches in _generate_batch overlap
+        try:
+            # Use today's queued tweet, or generate a fresh batch when there isn't one
+            key = today.date().isoformat()
+            queue = self._load_queue()
+            if key in queue:
+                logger.info("Using queued tweet for %s", key)
+            else:
+                queue = {**queue, **self._generate_batch(today)}
+            
+            tweet_text = queue.get(key)
+            if not tweet_text:
+                logger.warning("Failed to generate tweet, exiting")
+                return False
+            
+            # Post tweet
+            success = self.post_tweet(tweet_text)
+            if success:
+                # Drop today's tweet, and any left over from missed days
+                self._save_queue({day: text for day, text in queue.items() if day > key})
+                logger.info("✅ Bot completed successfully")
+                return True
+            else:
+                logger.error("❌ Bot failed to post tweet")
+                return False
+        except RunTimeout:
+            # Distinct reason code so cron monitoring can tell timeouts apart
+            logger.error("❌ TIMEOUT: bot exceeded %ds deadline", RUN_DEADLINE)
             return False
+        finally:
+            if use_alarm:
+                signal.alarm(0)
+                signal.signal(signal.SIGALRM, previous_handler)
+            self.gemini_session.close()
+            self.events_session.close()
 
 def main():
     """Main function - runs once and exits"""